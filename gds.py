@@ -1,15 +1,20 @@
-import copy
-from dataclasses import dataclass
+import argparse
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from math import ceil, floor
-from phidl import Device, set_quickplot_options
-from phidl import quickplot
+from phidl import Device
+from phidl.device_layout import CellArray
+import gdstk
 import phidl.geometry as pg
 import phidl.routing as pr
 import numpy as np
 from collections.abc import Callable
-import matplotlib.pyplot as plt
 
-set_quickplot_options(blocking=True, show_subports=True)
+# quickplot pulls in matplotlib, so only import it when a plot is actually requested
+def _quickplot(device: Device):
+    from phidl import quickplot, set_quickplot_options
+    set_quickplot_options(blocking=True, show_subports=True)
+    quickplot(device)
 
 #vanadium-1
 #gold-2
@@ -19,7 +24,32 @@ set_quickplot_options(blocking=True, show_subports=True)
 #sweep within waveguide defect width from 0.515-0.63
 #sweep across x electrode gap from 0.1 to max, 0.5 (geometrically limited)
 
-@dataclass
+@dataclass(frozen=True, eq=True, slots=True)
+class CrystalParameters:
+    crystal_width: float
+    crystal_height: float
+    bridge_width: float
+    defect_width: float
+    defect_height: float
+
+    lattice_constant: float
+    crystal_count: int
+
+    crystal_layer: int = 8
+
+    # derived once at construction; slotted instances have no __dict__ for cached_property to use
+    half_crystal_length: float = field(init=False, repr=False, compare=False)
+    total_crystal_length: float = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "half_crystal_length", self.lattice_constant*self.crystal_count)
+        object.__setattr__(self, "total_crystal_length", self.half_crystal_length*2 + self.defect_width)
+
+    def num_divisions(self) -> list[int]:
+        # the crystal is a long thin strip along x, so booleans over it are tiled along x
+        return [max(1, int(self.total_crystal_length//20)), 1]
+
+@dataclass(frozen=True, eq=True, slots=True)
 class DeviceParameters:
     total_length: float
 
@@ -45,77 +75,149 @@ class DeviceParameters:
     unetched: bool = False
     off_defect: bool = False
 
+    # the crystal geometry subset, derived once at construction
+    crystal: CrystalParameters = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        crystal = CrystalParameters(
+            crystal_width=self.crystal_width,
+            crystal_height=self.crystal_height,
+            bridge_width=self.bridge_width,
+            defect_width=self.defect_width,
+            defect_height=self.defect_height,
+            lattice_constant=self.lattice_constant,
+            crystal_count=self.crystal_count,
+            crystal_layer=self.crystal_layer,
+        )
+        object.__setattr__(self, "crystal", crystal)
+
+    @property
     def half_crystal_length(self) -> float:
-        return self.lattice_constant*self.crystal_count
-    
+        return self.crystal.half_crystal_length
+
+    @property
     def total_crystal_length(self) -> float:
-        return self.half_crystal_length()*2 + self.defect_width
+        return self.crystal.total_crystal_length
 
-def generate_device(parameters: DeviceParameters, include_blank: bool = True):
-    assert parameters.crystal_count % 2 == 1
+# dataclass hashes over numeric fields are stable between runs (unlike str hashes), so cell names are too
+def _cell_name(prefix: str, parameters) -> str:
+    return f"{prefix}_{hash(parameters) & 0xFFFFFFFFFFFFFFFF:016x}"
 
-    device = Device()
+# shared primitive cells; callers only ever add_ref these, never move or modify them
+@lru_cache(maxsize=None)
+def _rect(size: tuple[float, float], layer: int = 0):
+    return pg.rectangle(size, layer=layer)
+
+@lru_cache(maxsize=None)
+def _connector(width: float):
+    return pg.connector(width=width)
+
+# cut every cutter out of base in a single boolean; chaining NOTs would re-sweep base once per cutter
+def subtract_many(base, cutters, layer, num_divisions=None):
+    return pg.boolean(base, list(cutters), operation='NOT', layer=layer, num_divisions=num_divisions or [1, 1])
+
+# crystals, bridges and defect, centred on the defect with ports 1/2 at the bridge ends
+@lru_cache(maxsize=None)
+def _build_core(crystal: CrystalParameters):
+    assert crystal.crystal_count % 2 == 1
+
+    core = Device()
 
     half_crystal = Device()
 
-    crystal_t = pg.rectangle((parameters.crystal_width, parameters.crystal_height), parameters.crystal_layer)
+    crystal_t = _rect((crystal.crystal_width, crystal.crystal_height), crystal.crystal_layer)
 
-    half_crystal.add_ref([crystal_t] * parameters.crystal_count)
+    # centred on the origin; the array's span is known, so no bbox lookup is needed to centre it
+    crystals = half_crystal.add_array(crystal_t, columns=crystal.crystal_count, rows=1, spacing=(crystal.lattice_constant, 0))
+    crystals.move((-((crystal.crystal_count-1)*crystal.lattice_constant + crystal.crystal_width)/2, -crystal.crystal_height/2))
 
-    half_crystal.distribute(spacing=parameters.lattice_constant, separation=False, edge="x")
-    half_crystal.align(alignment='y')
-    half_crystal.move(half_crystal.center, destination=(0, 0))
-    
-    bridge=half_crystal.add_ref(pg.straight((parameters.bridge_width, parameters.half_crystal_length()), layer=parameters.crystal_layer))
-    bridge.move(bridge.center, (0, 0))
-    bridge.rotate(90)
+    half_length = crystal.half_crystal_length
+    half_crystal.add_ref(_rect((half_length, crystal.bridge_width), crystal.crystal_layer)).move((-half_length/2, -crystal.bridge_width/2))
 
-    half_crystal.add_port(1, port=bridge.ports[1])
-    half_crystal.add_port(2, port=bridge.ports[2])
-    
-    left_half = device.add_ref(half_crystal)
-    right_half = device.add_ref(half_crystal)
-    
-    defect = device.add_ref(pg.straight((parameters.defect_height, parameters.defect_width), parameters.crystal_layer))
-    defect.move(defect.center, (0,0))
-    defect.rotate(90)
-    
-    left_half.connect(1, defect.ports[2])
-    right_half.connect(2, defect.ports[1])
+    # the strip is 1-D along x, so the defect (placed by its corner) and both centred halves sit at plain offsets; no port connects needed
+    half_offset = (half_length + crystal.defect_width)/2
+    pieces = [
+        (-crystal.defect_width/2, -crystal.defect_height/2, _rect((crystal.defect_width, crystal.defect_height), crystal.crystal_layer)),
+        (-half_offset, 0, half_crystal),
+        (half_offset, 0, half_crystal),
+    ]
+    for x, y, piece in pieces:
+        core.add_ref(piece).move((x, y))
 
-    device.add_port(2, port=left_half.ports[2])
-    device.add_port(1, port=right_half.ports[1])
- 
-    internal_electrode = pg.rectangle((parameters.total_crystal_length(), max(parameters.defect_height, parameters.crystal_height)+0.1), layer=parameters.electrode_layer)
-    internal_electrode.move(internal_electrode.center, defect.center)
-    electrode_gap=pg.rectangle((parameters.defect_width-(parameters.electrode_overlap*2 if not parameters.off_defect else 0), parameters.total_crystal_length()))
-    electrode_gap.move(electrode_gap.center, defect.center)
-    # electrode_gap.rotate(-45, center=electrode_gap.center)
+    end = crystal.defect_width/2 + half_length
+    core.add_port(2, midpoint=(end, 0), width=crystal.bridge_width, orientation=0)
+    core.add_port(1, midpoint=(-end, 0), width=crystal.bridge_width, orientation=180)
 
-    if not parameters.shorted: internal_electrode=pg.boolean(internal_electrode, electrode_gap, operation="A-B", layer=parameters.electrode_layer)
+    return core
 
-    outline = pg.outline(device, parameters.outline_width, layer=parameters.outline_layer)
+# etch outline around the core, left open at both bridge ends; independent of the electrode settings
+@lru_cache(maxsize=None)
+def _build_outline(crystal: CrystalParameters, outline_width: float, outline_layer: int):
+    core = _build_core(crystal)
+    core_polygons = core.get_polygons()
 
+    # a total_crystal_length wide, outline_width deep rectangle just outside each end port
+    end_uncovers = []
     for i in [1,2]:
-        end_uncover = device.add_ref(pg.straight((parameters.total_crystal_length(), parameters.outline_width)))
-        end_uncover.connect(1, device.ports[i])
-        
-        outline = pg.boolean(outline, end_uncover, operation='NOT', layer=parameters.outline_layer)
-        device.remove(end_uncover)
+        port = core.ports[i]
+        direction = np.array([np.cos(np.radians(port.orientation)), np.sin(np.radians(port.orientation))])
+        normal = np.array([-direction[1], direction[0]])*crystal.total_crystal_length/2
+        depth = direction*outline_width
+        end_uncovers.append(np.array([port.center - normal, port.center + normal, port.center + normal + depth, port.center - normal + depth]))
+
+    # same as pg.outline (miter join, tolerance 2) but grown in one C++ pass, and the core and both
+    # end uncovers are cut out of the grown shape in a single boolean. these are raw gdstk polygons,
+    # which pg.boolean (and so subtract_many) would silently drop, hence gdstk.boolean directly
+    grown = gdstk.offset(core_polygons, outline_width, join="miter", tolerance=2, precision=1e-4, use_union=True)
+    outline_polygons = gdstk.boolean(grown, core_polygons + end_uncovers, "not", precision=1e-4)
+
+    outline = Device("outline")
+    outline.add_polygon([polygon.points for polygon in outline_polygons], layer=outline_layer)
+    return outline
+
+# parameters are hashable, so identical devices across the sweep are built once and referenced
+@lru_cache(maxsize=None)
+def generate_device(parameters: DeviceParameters, include_blank: bool = True):
+    crystal = parameters.crystal
+
+    device = Device(_cell_name("DEV", parameters))
+
+    core = device.add_ref(_build_core(crystal))
+
+    device.add_port(2, port=core.ports[2])
+    device.add_port(1, port=core.ports[1])
+ 
+    electrode_length = parameters.total_crystal_length
+    electrode_height = max(parameters.defect_height, parameters.crystal_height)+0.1
+
+    if parameters.shorted:
+        internal_electrode = Device()
+        electrode = internal_electrode.add_ref(_rect((electrode_length, electrode_height), parameters.electrode_layer))
+        electrode.move(electrode.center, core.center)
+    else:
+        # the gap is as tall as the crystal is long, so cutting it out of the electrode just leaves two flanking rectangles
+        electrode_gap_width = parameters.defect_width-(parameters.electrode_overlap*2 if not parameters.off_defect else 0)
+        internal_electrode = Device()
+        for side in [-1, 1]:
+            electrode_half = internal_electrode.add_ref(_rect(((electrode_length-electrode_gap_width)/2, electrode_height), parameters.electrode_layer))
+            electrode_half.move(electrode_half.center, core.center + (side*(electrode_length+electrode_gap_width)/4, 0))
+
+    # the outline is only drawn on etched devices (the blank cut-out always needs it)
+    outline = _build_outline(crystal, parameters.outline_width, parameters.outline_layer) if not include_blank or not parameters.unetched else None
     
     if not include_blank:
         # return outline
         test = Device()
         test.add_ref(pg.offset(pg.bbox(bbox=outline.bbox), distance=1))
-        return pg.boolean(test, outline, operation="A-B")
+        return subtract_many(test, [outline], 0, crystal.num_divisions())
 
     device.add_ref(internal_electrode)
     # device.add_ref(electrode_circles)
-    if not parameters.unetched: device.add_ref(outline)
+    if outline is not None: device.add_ref(outline)
 
-    external_electrode_length = (parameters.total_length - parameters.total_crystal_length())/2
+    external_electrode_length = (parameters.total_length - parameters.total_crystal_length)/2
     
-    connector = pg.connector(width=parameters.external_electrode_width)
+    connector = _connector(parameters.external_electrode_width)
     
     for i in [1, 2]:
       external_connector_i = device.add_ref(connector)
@@ -156,7 +258,10 @@ def generate_pads(
 
     return pads
     
-def generate_waveguide(
+# everything but the per-cell coordinate text, so cells of the same type share one body.
+# the "coordinates" port marks where generate_waveguide anchors that text
+@lru_cache(maxsize=None)
+def generate_waveguide_body(
     device_count: int,
     device_spacing: float,
     gap_spacing: float,
@@ -165,22 +270,25 @@ def generate_waveguide(
     pad_height: int,
     layer: int, 
     device_parameters_factory: Callable[[DeviceParameters, int], DeviceParameters],
-    coordinates: str
 ):
-    waveguides = Device()
+    waveguides = Device(_cell_name("WG", device_parameters))
     electrode_height = ceil(device_count/2)*device_spacing
 
     half_device_count = floor(device_count/2)
 
     center_electrode = waveguides.add_ref(pg.compass_multi((gap_spacing*2, electrode_height), {"N": 1, "E": half_device_count, "W": half_device_count}, layer=layer))
 
+    # build (or fetch from the cache) every device once, then only place references to them
+    devices = [generate_device(device_parameters_factory(device_parameters, i)) for i in range(device_count)]
+    device_overlap = (device_parameters.total_length-gap_spacing)/2
+
     for i in range(ceil(device_count/2)):
-        device_i = waveguides.add_ref(generate_device(device_parameters_factory(device_parameters, i)))
-        device_i.connect("E", center_electrode.ports[f"W{half_device_count-i}"], overlap=(device_parameters.total_length-gap_spacing)/2)
+        device_i = waveguides.add_ref(devices[i])
+        device_i.connect("E", center_electrode.ports[f"W{half_device_count-i}"], overlap=device_overlap)
 
     for i in range(floor(device_count/2)):
-        device_i = waveguides.add_ref(generate_device(device_parameters_factory(device_parameters, i+ceil(device_count/2))))
-        device_i.connect("W", center_electrode.ports[f"E{half_device_count-i}"], overlap=(device_parameters.total_length-gap_spacing)/2)
+        device_i = waveguides.add_ref(devices[i+ceil(device_count/2)])
+        device_i.connect("W", center_electrode.ports[f"E{half_device_count-i}"], overlap=device_overlap)
 
 
     side_electrode_width = (pad_width*4-gap_spacing*4)/2
@@ -229,9 +337,7 @@ def generate_waveguide(
     label = waveguides.add_ref(pg.text(text=label_text, justify='center', size=40, layer=layer))
     label.move(destination=(0, ymax+20))
 
-    coordinate_text = waveguides.add_ref(pg.text(text=coordinates, justify='left', size=40, layer=layer))
-    coordinate_text.move(destination=(xmax,ymax+15))
-    coordinate_text.rotate(-90, (xmax, ymax))
+    waveguides.add_port("coordinates", midpoint=(xmax, ymax), width=0, orientation=0)
     
     # quickplot(waveguides)
 
@@ -239,7 +345,98 @@ def generate_waveguide(
     
     return waveguides
 
-def generate_waveguide_grid():
+# the per-cell coordinate text, read downwards along the right edge of a body placed at the origin, 15 out from its anchor
+def add_coordinate_text(device: Device, body: Device, coordinates: str, layer: int):
+    anchor = body.ports["coordinates"]
+    coordinate_text = device.add_ref(pg.text(text=coordinates, justify='left', size=40, layer=layer))
+    coordinate_text.rotate(anchor.orientation-90)
+    coordinate_text.move(destination=anchor.center + 15*np.array([np.cos(np.radians(anchor.orientation)), np.sin(np.radians(anchor.orientation))]))
+    return coordinate_text
+
+def generate_waveguide(
+    device_count: int,
+    device_spacing: float,
+    gap_spacing: float,
+    device_parameters: DeviceParameters,
+    pad_width: int,
+    pad_height: int,
+    layer: int, 
+    device_parameters_factory: Callable[[DeviceParameters, int], DeviceParameters],
+    coordinates: str
+):
+    waveguides = Device()
+
+    body = generate_waveguide_body(device_count, device_spacing, gap_spacing, device_parameters, pad_width, pad_height, layer, device_parameters_factory)
+    waveguides.add_ref(body)
+    add_coordinate_text(waveguides, body, coordinates, layer)
+    
+    return waveguides
+
+_GDSTK_ANCHORS = {0: "nw", 1: "n", 2: "ne", 4: "w", 5: "o", 6: "e", 8: "sw", 9: "s", 10: "se"}
+
+# same output as Device.write_gds (hierarchy, names truncated/deduplicated the same way),
+# but the geometry is handed to gdstk's C++ writer instead of gdspy's pure python one
+def write_gds(
+    device: Device,
+    filename: str,
+    cellname: str = "toplevel",
+    max_cellname_length: int = 28,
+    unit: float = 1e-6,
+    precision: float = 1e-9,
+    max_points: int = 8190,
+):
+    dependencies = sorted(device.get_dependencies(recursive=True), key=lambda d: d.uid)
+
+    library = gdstk.Library(unit=unit, precision=precision)
+    cells = {device: library.new_cell(cellname)}
+    used_names = {cellname}
+    n = 1
+    for d in dependencies:
+        name = d.name[:max_cellname_length]
+        unique_name = name
+        while unique_name in used_names:
+            n += 1
+            unique_name = name + ("%0.3i" % n)
+        used_names.add(unique_name)
+        cells[d] = library.new_cell(unique_name)
+
+    for d, cell in cells.items():
+        for polygonset in d.polygons:
+            for points, layer, datatype in zip(polygonset.polygons, polygonset.layers, polygonset.datatypes):
+                cell.add(gdstk.Polygon(points, layer, datatype))
+
+        for ref in d.references:
+            repetition = dict(columns=ref.columns, rows=ref.rows, spacing=ref.spacing) if isinstance(ref, CellArray) else {}
+            cell.add(gdstk.Reference(
+                cells[ref.parent],
+                origin=ref.origin,
+                rotation=np.radians(ref.rotation or 0),
+                magnification=ref.magnification or 1,
+                x_reflection=bool(ref.x_reflection),
+                **repetition
+            ))
+
+        for label in d.labels:
+            cell.add(gdstk.Label(
+                label.text,
+                label.position,
+                anchor=_GDSTK_ANCHORS[label.anchor],
+                rotation=np.radians(label.rotation or 0),
+                magnification=label.magnification or 1,
+                x_reflection=bool(label.x_reflection),
+                layer=label.layer,
+                texttype=label.texttype,
+            ))
+
+    # gdstk's default of 199 points would re-fracture larger polygons into many small ones on write;
+    # 8190 is the GDSII record limit, so polygons are only split when they have to be
+    library.write_gds(filename, max_points=max_points)
+    return filename
+
+def device_parameters_factory(device_parameters_o: DeviceParameters, i: int):
+    return replace(device_parameters_o, defect_width=device_parameters_o.defect_width + i*0.010)
+
+def generate_waveguide_grid(plot: bool = False):
     device_parameters = DeviceParameters(
         total_length    = 40.0,
         crystal_width   = 0.600 + 0.030,
@@ -255,11 +452,6 @@ def generate_waveguide_grid():
         external_electrode_skew=5,
     )
 
-    def device_parameters_factory(device_parameters_o: DeviceParameters, i: int):
-        device_parameters=copy.copy(device_parameters_o)
-        device_parameters.defect_width += i*0.010
-        return device_parameters
-
     layout = Device()
 
     normal = (0, 0, 0)
@@ -270,32 +462,48 @@ def generate_waveguide_grid():
     #7
     columns = [normal, off_defect]*3 + [normal]*1
 
+    cell_settings = dict(
+        device_count=10, 
+        device_spacing=20, 
+        gap_spacing=25, 
+        layer=2, 
+        pad_width=300,
+        pad_height=450,
+        device_parameters_factory=device_parameters_factory,
+    )
+
+    # built in-process on purpose: cells from a process pool come back as pickled copies and lose the cached sub-cell sharing
+    # consecutive rows of a column that share a body are placed as one array; only the coordinate text is per cell
+    runs = []
     for x, column_type in enumerate(columns):
         for y in range(4):
             type = column_type
             if y == 0: type = shorted if x%2==0 else unetched
-            (device_parameters.shorted, device_parameters.unetched, device_parameters.off_defect) = type
-            cell = layout.add_ref(generate_waveguide(
-                device_count=10, 
-                device_spacing=20, 
-                gap_spacing=25, 
-                device_parameters=device_parameters,
-                layer=2, 
-                pad_width=300,
-                pad_height=450,
-                device_parameters_factory=device_parameters_factory,
-                coordinates=f"({x},{y})"
-            ))
-            cell.move(destination=((cell.xsize*0.75)*x, cell.ysize*(y+0.5*(x%2))))
+            (is_shorted, is_unetched, is_off_defect) = type
+            body = generate_waveguide_body(device_parameters=replace(device_parameters, shorted=is_shorted, unetched=is_unetched, off_defect=is_off_defect), **cell_settings)
+            coordinate_text = add_coordinate_text(layout, body, f"({x},{y})", cell_settings["layer"])
+
+            cell_size = np.max([body.bbox[1], coordinate_text.bbox[1]], axis=0) - np.min([body.bbox[0], coordinate_text.bbox[0]], axis=0)
+            destination = np.array(((cell_size[0]*0.75)*x, cell_size[1]*(y+0.5*(x%2))))
+            coordinate_text.move(destination)
+
+            if runs and runs[-1]["body"] is body and np.allclose(destination, runs[-1]["next"]):
+                runs[-1]["rows"] += 1
+            else:
+                runs.append({"body": body, "origin": destination, "rows": 1, "pitch": cell_size[1]})
+            runs[-1]["next"] = destination + (0, cell_size[1])
+
+    for run in runs:
+        layout.add_array(run["body"], columns=1, rows=run["rows"], spacing=(0, run["pitch"])).move(run["origin"])
 
     layout.center = (0, 0)
 
-    # quickplot(layout)
-    layout.write_gds("out.gds")
+    if plot: _quickplot(layout)
+    write_gds(layout, "out.gds")
     print("written to out.gds")
 
 
-def generate_crystal_geometry():
+def generate_crystal_geometry(plot: bool = False):
     device_parameters = DeviceParameters(
         total_length    = 40.0,
         crystal_width   = 0.600 + 0.030,
@@ -312,17 +520,20 @@ def generate_crystal_geometry():
     )
 
     device=generate_device(device_parameters, False)
-    quickplot(device)
     polygons = device.get_polygons()
     # polygons = [((0,0), (1, 0), (1, 1), (0, 1))]
 
-    # Plot polygons using matplotlib
-    fig, ax = plt.subplots()
-    for poly in polygons:
-      poly = np.array(poly)
-      ax.fill(poly[:, 0], poly[:, 1], alpha=0.5)
-    ax.set_aspect('equal')
-    plt.show()
+    if plot:
+      _quickplot(device)
+
+      # Plot polygons using matplotlib
+      import matplotlib.pyplot as plt
+      fig, ax = plt.subplots()
+      for poly in polygons:
+        poly = np.array(poly)
+        ax.fill(poly[:, 0], poly[:, 1], alpha=0.5)
+      ax.set_aspect('equal')
+      plt.show()
 
 
     depth = 0.1
@@ -361,5 +572,9 @@ def generate_crystal_geometry():
 
 
 if __name__ == "__main__":
-    generate_waveguide_grid()
-    # generate_crystal_geometry()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plot", action="store_true", help="quickplot the generated geometry before writing it")
+    args = parser.parse_args()
+
+    generate_waveguide_grid(plot=args.plot)
+    # generate_crystal_geometry(plot=args.plot)
\ No newline at end of file